@@ -0,0 +1,342 @@
+# cython: language_level=3
+"""Fast reader for PINCAST netcdf files using the netCDF C library.
+
+The fields are read directly into float32 NumPy arrays with the CF packing
+and fill value attributes applied, without going through netCDF4-python.
+All netCDF errors are raised as RuntimeError, so that the importer can fall
+back to the netCDF4 reader.
+"""
+
+import os
+
+import numpy as np
+
+cimport numpy as cnp
+from libc.math cimport NAN
+from libc.stdlib cimport free, malloc
+
+cnp.import_array()
+
+
+cdef extern from "netcdf.h" nogil:
+    ctypedef int nc_type
+
+    enum:
+        NC_NOERR
+        NC_NOWRITE
+        NC_GLOBAL
+        NC_CHUNKED
+        NC_ENOTVAR
+        NC_ENOTATT
+        NC_CHAR
+        NC_INT
+        NC_DOUBLE
+        NC_UINT
+        NC_INT64
+        NC_UINT64
+        NC_STRING
+        NC_MAX_VAR_DIMS
+
+    const char *nc_strerror(int ncerr)
+    int nc_open(const char *path, int mode, int *ncidp)
+    int nc_close(int ncid)
+    int nc_inq_varid(int ncid, const char *name, int *varidp)
+    int nc_inq_varndims(int ncid, int varid, int *ndimsp)
+    int nc_inq_vardimid(int ncid, int varid, int *dimidsp)
+    int nc_inq_vartype(int ncid, int varid, nc_type *xtypep)
+    int nc_inq_type(int ncid, nc_type xtype, char *name, size_t *sizep)
+    int nc_inq_dimlen(int ncid, int dimid, size_t *lenp)
+    int nc_inq_var_chunking(int ncid, int varid, int *storagep, size_t *chunksizesp)
+    int nc_set_var_chunk_cache(
+        int ncid, int varid, size_t size, size_t nelems, float preemption
+    )
+    int nc_get_vara_float(
+        int ncid, int varid, const size_t *startp, const size_t *countp, float *ip
+    )
+    int nc_get_vara_double(
+        int ncid, int varid, const size_t *startp, const size_t *countp, double *ip
+    )
+    int nc_get_var_double(int ncid, int varid, double *ip)
+    int nc_inq_att(
+        int ncid, int varid, const char *name, nc_type *xtypep, size_t *lenp
+    )
+    int nc_get_att_double(int ncid, int varid, const char *name, double *ip)
+    int nc_get_att_text(int ncid, int varid, const char *name, char *ip)
+    int nc_get_att_string(int ncid, int varid, const char *name, char **ip)
+    int nc_free_string(size_t len, char **data)
+
+
+cdef _check(int status):
+    if status != NC_NOERR:
+        raise RuntimeError(nc_strerror(status).decode("utf-8", "replace"))
+
+
+cdef list _var_shape(int ncid, int varid):
+    cdef int ndims
+    cdef int dimids[NC_MAX_VAR_DIMS]
+    cdef size_t length
+    cdef int i
+
+    _check(nc_inq_varndims(ncid, varid, &ndims))
+    _check(nc_inq_vardimid(ncid, varid, dimids))
+    shape = []
+    for i in range(ndims):
+        _check(nc_inq_dimlen(ncid, dimids[i], &length))
+        shape.append(length)
+    return shape
+
+
+cdef _set_chunk_cache(int ncid, int varid, list shape):
+    # Same sizing as _set_chunk_cache in importer_pincast_netcdf
+    cdef int storage
+    cdef size_t chunks[NC_MAX_VAR_DIMS]
+    cdef nc_type xtype
+    cdef size_t itemsize
+    cdef int i
+
+    _check(nc_inq_var_chunking(ncid, varid, &storage, chunks))
+    if storage != NC_CHUNKED:
+        return
+
+    size = os.environ.get("PINCAST_NC_CHUNK_CACHE")
+    if size is not None:
+        size = int(size)
+    else:
+        _check(nc_inq_vartype(ncid, varid, &xtype))
+        _check(nc_inq_type(ncid, xtype, NULL, &itemsize))
+        chunk_size = itemsize
+        for i in range(len(shape)):
+            chunk_size *= chunks[i]
+        row_chunk = chunks[len(shape) - 1]
+        chunks_per_row = (shape[-1] + row_chunk - 1) // row_chunk
+        size = max(64 << 20, 2 * chunk_size * chunks_per_row)
+    _check(nc_set_var_chunk_cache(ncid, varid, size, 4013, 0.75))
+
+
+cdef _get_att_doubles(int ncid, int varid, const char *name):
+    """Return a numeric attribute as a list of floats, or None if missing."""
+    cdef nc_type xtype
+    cdef size_t length
+    cdef double *values
+    cdef size_t i
+    cdef int status = nc_inq_att(ncid, varid, name, &xtype, &length)
+
+    if status == NC_ENOTATT:
+        return None
+    _check(status)
+
+    values = <double *>malloc(length * sizeof(double))
+    if values == NULL:
+        raise MemoryError()
+    try:
+        _check(nc_get_att_double(ncid, varid, name, values))
+        return [values[i] for i in range(length)]
+    finally:
+        free(values)
+
+
+cdef _get_att_text(int ncid, int varid, const char *name):
+    """Return a text attribute as str, or None if missing."""
+    cdef nc_type xtype
+    cdef size_t length
+    cdef char *text
+    cdef int status = nc_inq_att(ncid, varid, name, &xtype, &length)
+
+    if status == NC_ENOTATT:
+        return None
+    _check(status)
+
+    if xtype == NC_STRING and length == 1:
+        _check(nc_get_att_string(ncid, varid, name, &text))
+        try:
+            return text.decode("utf-8")
+        finally:
+            nc_free_string(1, &text)
+    if xtype != NC_CHAR:
+        raise RuntimeError("Unsupported attribute type")
+
+    text = <char *>malloc(length + 1)
+    if text == NULL:
+        raise MemoryError()
+    try:
+        _check(nc_get_att_text(ncid, varid, name, text))
+        return text[:length].decode("utf-8")
+    finally:
+        free(text)
+
+
+cdef cnp.ndarray _read_field(int ncid, str name, slice yslice, slice xslice):
+    """Read a field as float32, dropping leading dimensions of length 1.
+
+    Only the pixels selected by `yslice` and `xslice` along the last two
+    dimensions are read. The fill values are compared in float64 for 32-bit
+    integer and float64 fields, which float32 cannot represent exactly.
+    64-bit integer fields are not supported.
+    """
+    cdef int varid
+    cdef cnp.npy_intp dims[NC_MAX_VAR_DIMS]
+    cdef size_t start[NC_MAX_VAR_DIMS]
+    cdef size_t count[NC_MAX_VAR_DIMS]
+    cdef cnp.ndarray data
+    cdef float *values
+    cdef cnp.ndarray raw
+    cdef double *raw_values
+    cdef double[::1] fill_values
+    cdef nc_type xtype
+    cdef float scale_factor = 1
+    cdef float add_offset = 0
+    cdef Py_ssize_t i, k, size, nfill
+    cdef bint masked
+    cdef int ndim
+
+    bname = name.encode("utf-8")
+    _check(nc_inq_varid(ncid, bname, &varid))
+    _check(nc_inq_vartype(ncid, varid, &xtype))
+    if xtype == NC_INT64 or xtype == NC_UINT64:
+        raise RuntimeError("64-bit integer fields are not supported")
+
+    shape = _var_shape(ncid, varid)
+    ndim = len(shape)
+    if ndim < 2:
+        raise RuntimeError("Fields must have at least 2 dimensions")
+    _set_chunk_cache(ncid, varid, shape)
+
+    for i in range(ndim):
+        start[i] = 0
+        count[i] = shape[i]
+    ystart, ystop, _ = yslice.indices(shape[ndim - 2])
+    xstart, xstop, _ = xslice.indices(shape[ndim - 1])
+    start[ndim - 2] = ystart
+    count[ndim - 2] = ystop - ystart
+    start[ndim - 1] = xstart
+    count[ndim - 1] = xstop - xstart
+
+    shape = [count[i] for i in range(ndim)]
+    while len(shape) > 2 and shape[0] == 1:
+        shape = shape[1:]
+
+    for i in range(len(shape)):
+        dims[i] = shape[i]
+    data = cnp.PyArray_EMPTY(len(shape), dims, cnp.NPY_FLOAT32, 0)
+    values = <float *>cnp.PyArray_DATA(data)
+    size = cnp.PyArray_SIZE(data)
+
+    scale = _get_att_doubles(ncid, varid, b"scale_factor")
+    if scale:
+        scale_factor = scale[0]
+    offset = _get_att_doubles(ncid, varid, b"add_offset")
+    if offset:
+        add_offset = offset[0]
+    fill_values = np.array(
+        (_get_att_doubles(ncid, varid, b"_FillValue") or [])
+        + (_get_att_doubles(ncid, varid, b"missing_value") or []),
+        dtype=np.float64,
+    )
+    nfill = fill_values.shape[0]
+
+    if nfill > 0 and (xtype == NC_INT or xtype == NC_UINT or xtype == NC_DOUBLE):
+        # Valid values close to a fill value can round to it in float32, so
+        # these types are compared in float64, which represents them exactly
+        raw = cnp.PyArray_EMPTY(len(shape), dims, cnp.NPY_FLOAT64, 0)
+        raw_values = <double *>cnp.PyArray_DATA(raw)
+        _check(nc_get_vara_double(ncid, varid, start, count, raw_values))
+        with nogil:
+            for i in range(size):
+                masked = False
+                for k in range(nfill):
+                    if raw_values[i] == fill_values[k]:
+                        masked = True
+                if masked:
+                    values[i] = NAN
+                else:
+                    values[i] = <float>raw_values[i] * scale_factor + add_offset
+        return data
+
+    _check(nc_get_vara_float(ncid, varid, start, count, values))
+    for k in range(nfill):
+        fill_values[k] = <float>fill_values[k]
+    with nogil:
+        for i in range(size):
+            masked = False
+            for k in range(nfill):
+                if values[i] == fill_values[k]:
+                    masked = True
+            if masked:
+                values[i] = NAN
+            else:
+                values[i] = values[i] * scale_factor + add_offset
+    return data
+
+
+cdef cnp.ndarray _read_coord(int ncid, str name):
+    """Read a coordinate variable as float64."""
+    cdef int varid
+    cdef cnp.ndarray data
+
+    bname = name.encode("utf-8")
+    _check(nc_inq_varid(ncid, bname, &varid))
+    data = np.empty(_var_shape(ncid, varid), dtype=np.float64)
+    _check(nc_get_var_double(ncid, varid, <double *>cnp.PyArray_DATA(data)))
+    return data
+
+
+def read(filename, precip_field, quality_field=None, subset=None):
+    """Read the fields, coordinates and header of a PINCAST netcdf file.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file to read.
+    precip_field : str or None
+        Name of the precipitation field. If None, the field is not read.
+    quality_field : str or None
+        Name of the quality field. If None, the field is not read.
+    subset : callable or None
+        Function returning the y and x slices of the fields to read, given
+        the x and y coordinates. If None, the whole fields are read.
+
+    Returns
+    -------
+    tuple
+        The decoded float32 precipitation and quality fields (or None), the
+        x and y coordinates of the fields, the `crs_wkt` attribute of the `spatial_ref`
+        variable and the `nc.institution` global attribute (or None if
+        missing).
+    """
+    cdef int ncid
+    cdef int varid
+    cdef int status
+
+    bfilename = os.fsencode(filename)
+    _check(nc_open(bfilename, NC_NOWRITE, &ncid))
+    try:
+        x = _read_coord(ncid, "x")
+        y = _read_coord(ncid, "y")
+        if subset is not None:
+            yslice, xslice = subset(x, y)
+        else:
+            yslice, xslice = slice(None), slice(None)
+        x = x[xslice]
+        y = y[yslice]
+
+        if precip_field is not None:
+            precip = _read_field(ncid, precip_field, yslice, xslice)
+        else:
+            precip = None
+        if quality_field is not None:
+            quality = _read_field(ncid, quality_field, yslice, xslice)
+        else:
+            quality = None
+
+        status = nc_inq_varid(ncid, b"spatial_ref", &varid)
+        if status == NC_ENOTVAR:
+            wkt = None
+        else:
+            _check(status)
+            wkt = _get_att_text(ncid, varid, b"crs_wkt")
+
+        institution = _get_att_text(ncid, NC_GLOBAL, b"nc.institution")
+    finally:
+        nc_close(ncid)
+
+    return precip, quality, x, y, wkt, institution
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Numba kernels used by the importers.
+
+This module requires numba and is only imported by the importers when it is
+available.
+"""
+
+import numba as nb
+import numpy as np
+
+
+@nb.njit(parallel=True, cache=True)
+def cast_f32_2d(src, dst, scale_factor, add_offset, fill_values):
+    """Cast, unpack and mask a 2D field into float32 in a single pass,
+    splitting rows across cores."""
+    for i in nb.prange(src.shape[0]):
+        for j in range(src.shape[1]):
+            value = src[i, j]
+            masked = False
+            for k in range(fill_values.shape[0]):
+                if value == fill_values[k]:
+                    masked = True
+            if masked:
+                dst[i, j] = np.nan
+            else:
+                dst[i, j] = np.float32(value) * scale_factor + add_offset
+
+
+# Compile the kernel for the most common packed data type at import time
+cast_f32_2d(
+    np.zeros((4, 4), dtype=np.int16),
+    np.empty((4, 4), dtype=np.float32),
+    np.float32(1),
+    np.float32(0),
+    np.zeros(1, dtype=np.int16),
+)
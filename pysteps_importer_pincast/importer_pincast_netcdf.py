@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 """Importers for netCDF files.
 
-Import a precipitation field from a NetCDF4 file.
+Import a precipitation field from a NetCDF4 file, or a stack of
+precipitation fields from several NetCDF4 files at once.
 The format of the files is assumed to be the same as produced by the
 PINCAST `radar_composite_generator` module.
 
@@ -51,16 +52,401 @@ The metadata contains the following key-value pairs:
 """
 
 # Import the needed libraries
+import functools
+import os
+from collections import namedtuple
+
 import numpy as np
-import rioxarray
-import xarray as xr
 
 from pysteps.decorators import postprocess_import
 
+# netCDF4, pyproj, xarray and numba are imported when first needed, so that
+# the plugin discovery by pysteps does not pay for loading them
+
+# xarray engine used to open the files. Setting it explicitly avoids the
+# engine autodetection on every open. h5netcdf is preferred for its lower
+# per-open cost, "netcdf4" can be used instead.
+_ENGINE = os.environ.get("PINCAST_NC_ENGINE", "h5netcdf")
+
+
+def _set_chunk_cache(var):
+    """Size the chunk cache of a chunked netCDF4 variable.
+
+    The cache holds at least two rows of chunks, so that no chunk is
+    decompressed more than once while reading the variable. The default
+    size of 64 MiB can be overridden with the `PINCAST_NC_CHUNK_CACHE`
+    environment variable (in bytes).
+    """
+    # Variables of classic format files have no chunking information
+    chunking = var.chunking()
+    if chunking is None or chunking == "contiguous":
+        return
+
+    size = os.environ.get("PINCAST_NC_CHUNK_CACHE")
+    if size is not None:
+        size = int(size)
+    else:
+        chunks_per_row = -(-var.shape[-1] // chunking[-1])
+        row_size = int(np.prod(chunking)) * var.dtype.itemsize * chunks_per_row
+        size = max(64 << 20, 2 * row_size)
+    var.set_var_chunk_cache(size=size, nelems=4013, preemption=0.75)
+
+
+def _coord_slice(coord, lower, upper):
+    """Return the slice of a monotonic coordinate with values in [lower, upper]."""
+    if coord[0] <= coord[-1]:
+        start = np.searchsorted(coord, lower, side="left")
+        stop = np.searchsorted(coord, upper, side="right")
+    else:
+        # Descending coordinate (e.g. y with the origin at the upper border)
+        n = len(coord)
+        start = n - np.searchsorted(coord[::-1], upper, side="right")
+        stop = n - np.searchsorted(coord[::-1], lower, side="left")
+    if stop - start < 2:
+        raise ValueError(
+            "The bounding box must contain at least two pixels in both directions"
+        )
+    return slice(int(start), int(stop))
+
+
+def _subset_slices(x, y, bbox):
+    """Return the y and x slices of the pixels inside a bounding box.
+
+    The bounding box is given as (x1, y1, x2, y2). If it is None, the slices
+    select the whole field.
+    """
+    if bbox is None:
+        return slice(None), slice(None)
+    x1, y1, x2, y2 = bbox
+    return _coord_slice(y, y1, y2), _coord_slice(x, x1, x2)
+
+
+def _read_field(var, yslice, xslice):
+    """Read a 2D field and its attributes from a netCDF4 variable.
+
+    Leading dimensions of length 1 (e.g. time) are indexed away before the
+    read, so that no extra squeezed view of the data is needed. Only the
+    pixels selected by `yslice` and `xslice` are read.
+    """
+    index = tuple(0 if n == 1 else slice(None) for n in var.shape[:-2])
+    attrs = {name: var.getncattr(name) for name in var.ncattrs()}
+    _set_chunk_cache(var)
+    return var[index + (yslice, xslice)], attrs
+
+
+@functools.lru_cache(maxsize=None)
+def _get_fastread():
+    """Return the compiled _fastread module, or None if it was not built."""
+    try:
+        from pysteps_importer_pincast import _fastread
+    except ImportError:
+        return None
+    return _fastread
+
+
+# The attributes of fields that are already decoded to float32 by the reader
+# are None
+_RawFields = namedtuple(
+    "_RawFields",
+    [
+        "precip",
+        "precip_attrs",
+        "quality",
+        "quality_attrs",
+        "x",
+        "y",
+        "wkt",
+        "institution",
+    ],
+)
+
+
+def _read_fields(filename, precip_field, quality_field, bbox):
+    """Read the raw fields and header information needed by the importer.
+
+    If `precip_field` is None, only the coordinates and header are read.
+    If `bbox` is not None, only the pixels inside it are read.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+    if magic in (b"CDF\x01", b"CDF\x02"):
+        return _read_classic(filename, precip_field, quality_field, bbox)
+
+    fastread = _get_fastread()
+    if fastread is not None:
+        try:
+            precip, quality, x, y, wkt, institute = fastread.read(
+                filename,
+                precip_field,
+                quality_field,
+                subset=functools.partial(_subset_slices, bbox=bbox),
+            )
+        except RuntimeError:
+            # Not supported by the fast reader, use netCDF4 instead
+            pass
+        else:
+            # The fields are already decoded to float32
+            return _RawFields(precip, None, quality, None, x, y, wkt, institute)
+
+    import netCDF4
+
+    # Read the needed variables directly from the netcdf file, without going
+    # through the xarray decoding machinery
+    with netCDF4.Dataset(filename, "r") as nc:
+        # Packing and fill values are applied by _decode_float32 in single
+        # precision instead of by netCDF4 in double precision
+        nc.set_auto_maskandscale(False)
+
+        x = nc.variables["x"][:]
+        y = nc.variables["y"][:]
+        yslice, xslice = _subset_slices(x, y, bbox)
+        x = x[xslice]
+        y = y[yslice]
+
+        if precip_field is not None:
+            precip, precip_attrs = _read_field(
+                nc.variables[precip_field], yslice, xslice
+            )
+        else:
+            precip, precip_attrs = None, None
+
+        if quality_field is not None:
+            quality, quality_attrs = _read_field(
+                nc.variables[quality_field], yslice, xslice
+            )
+        else:
+            quality, quality_attrs = None, None
+
+        spatial_ref = nc.variables.get("spatial_ref")
+        if spatial_ref is not None and "crs_wkt" in spatial_ref.ncattrs():
+            wkt = spatial_ref.getncattr("crs_wkt")
+        else:
+            wkt = None
+
+        if "nc.institution" in nc.ncattrs():
+            institute = nc.getncattr("nc.institution")
+        else:
+            institute = None
+
+    return _RawFields(
+        precip, precip_attrs, quality, quality_attrs, x, y, wkt, institute
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def _open_cached(filename, mtime, precip_field, quality_field, bbox):
+    """Cached version of :func:`_read_fields`.
+
+    The results are cached by file name and modification time (`mtime`), so
+    that repeated imports of the same file skip opening and reading it. The
+    returned arrays are shared between calls and must not be modified.
+    """
+    return _read_fields(filename, precip_field, quality_field, bbox)
+
+
+def _get_fields(filename, precip_field, quality_field, bbox, cache):
+    """Read the raw fields, through the cache if `cache` is True.
+
+    With the cache, repeated imports of an unchanged file only pay for the
+    float32 conversion and the metadata construction.
+    """
+    if cache:
+        mtime = os.stat(filename).st_mtime_ns
+        return _open_cached(filename, mtime, precip_field, quality_field, bbox)
+    return _read_fields(filename, precip_field, quality_field, bbox)
+
+
+def _read_classic_field(var, yslice, xslice):
+    """Decode a field of a memory-mapped classic format file to float32."""
+    index = tuple(0 if n == 1 else slice(None) for n in var.shape[:-2])
+    attrs = {
+        name: getattr(var, name)
+        for name in ("scale_factor", "add_offset", "_FillValue", "missing_value")
+        if hasattr(var, name)
+    }
+    return _decode_float32(var.data[index + (yslice, xslice)], attrs)
+
+
+def _read_classic(filename, precip_field, quality_field, bbox):
+    """Read the fields and header of a classic format (netCDF3) file.
+
+    The variables of uncompressed classic format files are contiguous on
+    disk, so the file is memory-mapped and the fields are decoded to float32
+    straight from the mapped pages. The decoded fields are copies, since the
+    importer output may be modified in place and the map is closed here.
+    """
+    from scipy.io import netcdf_file
+
+    with netcdf_file(filename, mode="r", mmap=True) as f:
+        # No references to the mapped data may be left when the file is closed
+        x = f.variables["x"].data.copy()
+        y = f.variables["y"].data.copy()
+        yslice, xslice = _subset_slices(x, y, bbox)
+        x = x[xslice]
+        y = y[yslice]
+
+        if precip_field is not None:
+            precip = _read_classic_field(f.variables[precip_field], yslice, xslice)
+        else:
+            precip = None
+
+        if quality_field is not None:
+            quality = _read_classic_field(f.variables[quality_field], yslice, xslice)
+        else:
+            quality = None
+
+        wkt = getattr(f.variables.get("spatial_ref"), "crs_wkt", None)
+        institute = getattr(f, "nc.institution", None)
+
+    # Text attributes are returned as bytes
+    if isinstance(wkt, bytes):
+        wkt = wkt.decode("utf-8")
+    if isinstance(institute, bytes):
+        institute = institute.decode("utf-8")
+
+    return _RawFields(precip, None, quality, None, x, y, wkt, institute)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_cast_kernel():
+    """Return the numba cast kernel, or None if numba is not installed."""
+    try:
+        from pysteps_importer_pincast._kernels import cast_f32_2d
+    except ImportError:
+        return None
+    return cast_f32_2d
+
+
+def _decode_float32(raw, attrs):
+    """Convert a raw field to float32 using its CF encoding attributes.
+
+    The `scale_factor` and `add_offset` attributes are applied directly into
+    a float32 output array, and values equal to `_FillValue` or
+    `missing_value` are set to NaN. The output is always a new C-contiguous
+    array. If numba is installed, the conversion is done in a single
+    parallel pass over the data.
+    """
+    data = np.empty(raw.shape, dtype=np.float32)
+    scale_factor = attrs.get("scale_factor")
+    add_offset = attrs.get("add_offset")
+    fill_values = np.concatenate(
+        [np.ravel(attrs.get(name, [])) for name in ("_FillValue", "missing_value")]
+    )
+
+    cast_f32_2d = _get_cast_kernel()
+    if (
+        cast_f32_2d is not None
+        and raw.ndim >= 2
+        and raw.flags.c_contiguous
+        and raw.dtype.isnative
+    ):
+        # Stacks of fields are cast as one 2D array of rows
+        cast_f32_2d(
+            raw.reshape(-1, raw.shape[-1]),
+            data.reshape(-1, data.shape[-1]),
+            np.float32(1 if scale_factor is None else scale_factor),
+            np.float32(0 if add_offset is None else add_offset),
+            fill_values.astype(raw.dtype),
+        )
+        return data
+
+    if scale_factor is not None:
+        np.multiply(raw, np.float32(scale_factor), out=data, casting="unsafe")
+    else:
+        data[...] = raw
+    if add_offset is not None:
+        np.add(data, np.float32(add_offset), out=data)
+
+    for fill_value in fill_values:
+        data[raw == fill_value] = np.nan
+    return data
+
+
+def _field_float32(raw, attrs, copy):
+    """Return a field read by :func:`_get_fields` as float32.
+
+    Fields with attributes are decoded with :func:`_decode_float32`. Fields
+    already decoded by the reader are returned as is, or copied if `copy` is
+    True, e.g. when they are shared through the cache.
+    """
+    if attrs is not None:
+        return _decode_float32(raw, attrs)
+    return raw.copy() if copy else raw
+
+
+@functools.lru_cache(maxsize=64)
+def _crs_info(wkt):
+    """Return the PROJ.4 definition and the cartesian unit of a WKT CRS.
+
+    Files of the same composite share the same projection, so the results
+    are cached and PROJ is only called once per distinct WKT string.
+    """
+    import pyproj
+
+    crs = pyproj.CRS.from_wkt(wkt)
+    return crs.to_proj4(), crs.to_dict().get("units")
+
+
+# Metadata fields that are the same for all files
+_METADATA_TEMPLATE = dict(
+    unit="mm/h",
+    transform=None,
+    zerovalue=0,
+    yorigin="upper",
+    threshold=None,
+)
+
+
+def _build_metadata(x, y, wkt, institute):
+    """Build the pysteps metadata dictionary from the coordinates and header."""
+    # Adjust the metadata fields according to the file format specifications.
+    # For additional information on the metadata fields, see:
+    # https://pysteps.readthedocs.io/en/latest/pysteps_reference/io.html#pysteps-io-importers
+
+    # The projection definition is an string with a PROJ.4-compatible projection
+    # definition of the cartographic projection used for the data
+    # More info at: https://proj.org/usage/projections.html
+
+    # For example:
+    if wkt:
+        projection_definition, unit = _crs_info(wkt)
+    else:
+        projection_definition = None
+        unit = None
+
+    # The coordinates are monotonic, so the pixel sizes and the bounds are
+    # obtained by indexing instead of np.diff and min/max reductions
+    x = np.ascontiguousarray(x)
+    y = np.ascontiguousarray(y)
+    dx = x[1] - x[0]
+    dy = y[1] - y[0]
+    x1, x2 = (x[0], x[-1]) if dx > 0 else (x[-1], x[0])
+    y1, y2 = (y[0], y[-1]) if dy > 0 else (y[-1], y[0])
+
+    metadata = _METADATA_TEMPLATE.copy()
+    # Store plain Python floats instead of NumPy scalars
+    metadata.update(
+        xpixelsize=float(dx),
+        ypixelsize=float(dy),
+        cartesian_unit=unit,
+        institution=institute,
+        projection=projection_definition,
+        x1=float(x1),
+        x2=float(x2),
+        y1=float(y1),
+        y2=float(y2),
+    )
+    return metadata
+
 
 @postprocess_import()
 def importer_pincast_netcdf(
-    filename, precip_field: str = "RATE", quality_field: str = None, **kwargs
+    filename,
+    precip_field: str = "RATE",
+    quality_field: str = None,
+    bbox: tuple = None,
+    cache: bool = False,
+    **kwargs
 ):
     """Import a precipitation field from a NetCDF4 file.
 
@@ -72,7 +458,8 @@ def importer_pincast_netcdf(
     - precipitation field with name `precip_field` (e.g. RATE)
     - optionally, quality field with name `quality_field` (e.g. QUALITY)
     - x and y coordinates
-    - projection information available through ds.spatial_ref.crs_wkt
+    - projection information available through the `crs_wkt` attribute of the
+      `spatial_ref` variable
 
     Parameters
     ----------
@@ -85,6 +472,18 @@ def importer_pincast_netcdf(
     quality_field : str
         Name of the quality field to import from the netcdf file. If None, no quality is imported.
 
+    bbox : tuple of float
+        Bounding box (x1, y1, x2, y2) in the coordinates of the data. If given,
+        only the pixels with coordinates inside it are read, and the metadata
+        describes the subset. If None, the whole field is imported.
+
+    cache : bool
+        If True, the raw fields of the 32 most recently imported files are
+        kept in memory, so that repeated imports of an unchanged file skip
+        reading it. This is useful when the same files are imported many
+        times, e.g. in verification loops. The cache can be emptied with
+        `importer_pincast_netcdf.cache_clear()`.
+
     {extra_kwargs_doc}
 
     Returns
@@ -97,56 +496,149 @@ def importer_pincast_netcdf(
         Associated metadata (pixel sizes, map projections, etc.).
 
     """
-    # Read dataset from netcdf file
-    ds = xr.open_dataset(filename)
-    ds = ds.rio.write_crs(ds.spatial_ref.crs_wkt)
+    if bbox is not None:
+        bbox = tuple(bbox)
+
+    fields = _get_fields(filename, precip_field, quality_field, bbox, cache)
 
-    precip = ds[precip_field].data.astype(np.float32).squeeze()
+    precip = _field_float32(fields.precip, fields.precip_attrs, cache)
 
     # Quality field, should have the same dimensions of the precipitation field.
     # Use None is not information is available.
     if quality_field is not None:
-        quality = ds[quality_field].data.squeeze()
+        quality = _field_float32(fields.quality, fields.quality_attrs, cache)
     else:
         quality = None
 
-    # Adjust the metadata fields according to the file format specifications.
-    # For additional information on the metadata fields, see:
-    # https://pysteps.readthedocs.io/en/latest/pysteps_reference/io.html#pysteps-io-importers
+    metadata = _build_metadata(fields.x, fields.y, fields.wkt, fields.institution)
 
-    # The projection definition is an string with a PROJ.4-compatible projection
-    # definition of the cartographic projection used for the data
-    # More info at: https://proj.org/usage/projections.html
+    # IMPORTANT! The importers should always return the following fields:
+    return precip, quality, metadata
 
-    # For example:
-    try:
-        projection_definition = ds.rio.crs.to_proj4()
-        unit = ds.rio.crs.data["units"]
-    except:
-        projection_definition = None
-        unit = None
 
-    try:
-        institute = ds.attrs["nc.institution"]
-    except:
-        institute = None
+importer_pincast_netcdf.cache_clear = _open_cached.cache_clear
 
-    metadata = dict(
-        xpixelsize=np.diff(ds.coords["x"])[0],
-        ypixelsize=np.diff(ds.coords["y"])[0],
-        cartesian_unit=unit,
-        unit="mm/h",
-        transform=None,
-        zerovalue=0,
-        institution=institute,
-        projection=projection_definition,
-        yorigin="upper",
-        threshold=None,
-        x1=ds.x.data.min(),
-        x2=ds.x.data.max(),
-        y1=ds.y.data.min(),
-        y2=ds.y.data.max(),
-    )
 
-    # IMPORTANT! The importers should always return the following fields:
+def read_pincast_metadata(filename, bbox=None, cache=False):
+    """Read the metadata of a PINCAST netcdf file without its fields.
+
+    Only the coordinates and header of the file are read, so this is much
+    faster than importing the precipitation field with
+    :func:`importer_pincast_netcdf` when only the grid is needed.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file to read.
+
+    bbox : tuple of float
+        Bounding box (x1, y1, x2, y2) in the coordinates of the data. If given,
+        the metadata describes the pixels with coordinates inside it.
+
+    cache : bool
+        If True, the header is read through the cache of
+        :func:`importer_pincast_netcdf`.
+
+    Returns
+    -------
+    metadata : dict
+        Metadata as returned by :func:`importer_pincast_netcdf`.
+
+    """
+    if bbox is not None:
+        bbox = tuple(bbox)
+
+    fields = _get_fields(filename, None, None, bbox, cache)
+    return _build_metadata(fields.x, fields.y, fields.wkt, fields.institution)
+
+
+def _expand_time(ds, fields):
+    """Add a time dimension to the fields of `ds` that are stored without it,
+    so that they are concatenated along it by `xarray.open_mfdataset`."""
+    for name in fields:
+        if name is not None and "time" not in ds[name].dims:
+            ds[name] = ds[name].expand_dims("time")
+    return ds
+
+
+@postprocess_import()
+def importer_pincast_netcdf_mf(
+    filenames, precip_field: str = "RATE", quality_field: str = None, **kwargs
+):
+    """Import a stack of precipitation fields from several NetCDF4 files.
+
+    All files are opened at once with `xarray.open_mfdataset` and
+    concatenated along the `time` dimension, which amortizes the per-file
+    overhead of calling :func:`importer_pincast_netcdf` for each timestep.
+    Fields stored without a `time` dimension are given one of length 1.
+    The files should have the same format as described for
+    :func:`importer_pincast_netcdf` and identical x and y coordinates,
+    otherwise a ValueError is raised.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Names of the files to import, in time order.
+
+    precip_field : str
+        Name of the precipitation field to import from the netcdf files.
+
+    quality_field : str
+        Name of the quality field to import from the netcdf files. If None, no quality is imported.
+
+    {extra_kwargs_doc}
+
+    Returns
+    -------
+    precipitation : 3D array, float32
+        Precipitation fields in mm/h. The dimensions are [time, latitude, longitude].
+    quality : 3D array or None
+        If no quality information is available, set to None.
+    metadata : dict
+        Associated metadata (pixel sizes, map projections, etc.), common to
+        all the fields.
+
+    """
+    import xarray as xr
+
+    with xr.open_mfdataset(
+        filenames,
+        combine="nested",
+        concat_dim="time",
+        preprocess=functools.partial(
+            _expand_time, fields=(precip_field, quality_field)
+        ),
+        # Only the fields with a time dimension are concatenated, the rest are
+        # taken from the first file, and differing grids raise an error
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+        join="exact",
+        chunks={"x": 512, "y": 512},
+        parallel=True,
+        engine=_ENGINE,
+        # Only the raw fields, coordinates and attributes are needed, so the
+        # CF decoding is skipped and done by _decode_float32 instead
+        decode_cf=False,
+        decode_times=False,
+        decode_coords=False,
+        mask_and_scale=False,
+        cache=False,
+    ) as ds:
+        # Load the fields eagerly so that they are read in a single compute,
+        # and .values returns the loaded array without further indexing
+        precip = ds[precip_field].load()
+        precip = _decode_float32(precip.values, precip.attrs)
+
+        if quality_field is not None:
+            quality = ds[quality_field].load()
+            quality = _decode_float32(quality.values, quality.attrs)
+        else:
+            quality = None
+
+        wkt = ds["spatial_ref"].attrs.get("crs_wkt") if "spatial_ref" in ds else None
+        metadata = _build_metadata(
+            ds["x"].values, ds["y"].values, wkt, ds.attrs.get("nc.institution")
+        )
+
     return precip, quality, metadata
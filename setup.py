@@ -2,11 +2,69 @@
 
 """The setup script."""
 
-from setuptools import setup, find_packages
+import subprocess
+import warnings
+
+from setuptools import Extension, setup, find_packages
+from setuptools.command.build_ext import build_ext
 
 with open("README.rst") as readme_file:
     readme = readme_file.read()
 
+
+# Optional fast reader extension
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# The _fastread extension reads the files with the netCDF C library. Cython and
+# NumPy are listed as build requirements in pyproject.toml, and the importer
+# falls back to netCDF4-python if the extension is missing or fails to build.
+def _nc_config(option):
+    """Return the output of `nc-config option`, or None if not available."""
+    try:
+        return subprocess.check_output(["nc-config", option]).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class OptionalBuildExt(build_ext):
+    """Build the extensions, but only warn if the build fails."""
+
+    def run(self):
+        try:
+            super().run()
+        except Exception as err:
+            warnings.warn(f"Could not build the optional extensions: {err}")
+
+    def build_extension(self, ext):
+        try:
+            super().build_extension(ext)
+        except Exception as err:
+            warnings.warn(f"Could not build the optional extension {ext.name}: {err}")
+
+
+try:
+    import numpy
+    from Cython.Build import cythonize
+except ImportError as err:
+    warnings.warn(f"Not building the optional extensions: {err}")
+    ext_modules = []
+else:
+    nc_includedir = _nc_config("--includedir")
+    nc_libdir = _nc_config("--libdir")
+    ext_modules = cythonize(
+        [
+            Extension(
+                "pysteps_importer_pincast._fastread",
+                ["pysteps_importer_pincast/_fastread.pyx"],
+                include_dirs=[numpy.get_include()]
+                + ([nc_includedir] if nc_includedir else []),
+                library_dirs=[nc_libdir] if nc_libdir else [],
+                libraries=["netcdf"],
+            )
+        ],
+        language_level=3,
+    )
+
 # Add the plugin dependencies here
 requirements = []
 
@@ -36,6 +94,8 @@ setup(
     keywords=["pysteps_importer_pincast", "pysteps", "plugin", "importer"],
     name="pysteps-importer-pincast",
     packages=find_packages(),
+    ext_modules=ext_modules,
+    cmdclass={"build_ext": OptionalBuildExt},
     setup_requires=setup_requirements,
     # Entry points
     # ~~~~~~~~~~~~
@@ -66,6 +126,7 @@ setup(
     entry_points={
         "pysteps.plugins.importers": [
             "importer_pincast_netcdf=pysteps_importer_pincast.importer_pincast_netcdf:importer_pincast_netcdf",
+            "importer_pincast_netcdf_mf=pysteps_importer_pincast.importer_pincast_netcdf:importer_pincast_netcdf_mf",
             # Add additional importers if needed.
         ]
     },
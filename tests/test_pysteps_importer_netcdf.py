@@ -2,6 +2,62 @@
 
 """Tests for `pysteps_importer_pincast` package."""
 
+import os
+
+import numpy as np
+import pytest
+
+# pysteps loads the installed importer plugins when it is first imported, so it
+# must be imported before the plugin module itself
+import pysteps  # noqa: F401
+
+TEST_FILE = os.path.join(
+    os.path.dirname(__file__), "testdata", "KFWS_DPR_201905020230_RATE.nc"
+)
+
+
+def _write_packed_file(filename, file_format="NETCDF4", time=True):
+    """Write a small file with an int16 packed precipitation field, in the
+    same layout as the PINCAST composites. If `time` is False, the field has
+    no time dimension."""
+    import netCDF4
+    import pyproj
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(-100, 3000, size=(1, 40, 50)).astype(np.int16)
+    data[0, :5, :5] = -32768
+
+    with netCDF4.Dataset(filename, "w", format=file_format) as nc:
+        nc.setncattr("nc.institution", "TEST")
+        nc.createDimension("time", 1)
+        nc.createDimension("y", 40)
+        nc.createDimension("x", 50)
+
+        x = nc.createVariable("x", "f8", ("x",))
+        x[:] = np.arange(50) * 1000.0
+        # The origin is at the upper border, so y is descending
+        y = nc.createVariable("y", "f8", ("y",))
+        y[:] = np.arange(40)[::-1] * 1000.0
+
+        spatial_ref = nc.createVariable("spatial_ref", "i4", ())
+        spatial_ref.crs_wkt = pyproj.CRS.from_epsg(3067).to_wkt()
+
+        dims = ("time", "y", "x") if time else ("y", "x")
+        rate = nc.createVariable("RATE", "i2", dims, fill_value=np.int16(-32768))
+        rate.scale_factor = 0.01
+        rate.add_offset = 0.5
+        rate.set_auto_maskandscale(False)
+        rate[:] = data if time else data[0]
+    return filename
+
+
+def _decoded_by_xarray(filename, field="RATE"):
+    """Reference values of a field decoded by xarray."""
+    import xarray as xr
+
+    with xr.open_dataset(filename) as ds:
+        return ds[field].values.astype(np.float32).squeeze()
+
 
 def test_importers_discovery():
     """It is recommended to at least test that the importers provided by the plugin are
@@ -11,7 +67,7 @@ def test_importers_discovery():
 
     from pysteps.io import interface
 
-    new_importers = ["importer_pincast_netcdf"]
+    new_importers = ["importer_pincast_netcdf", "importer_pincast_netcdf_mf"]
     for importer in new_importers:
         assert importer.replace("import_", "") in interface._importer_methods
 
@@ -21,5 +77,279 @@ def test_importers_with_files():
     some example data.
     """
 
-    # Write the test here.
-    pass
+    from pysteps_importer_pincast.importer_pincast_netcdf import (
+        importer_pincast_netcdf,
+    )
+
+    precip, quality, metadata = importer_pincast_netcdf(TEST_FILE, dtype="float32")
+
+    assert precip.ndim == 2
+    assert precip.dtype == np.float32
+    assert quality is None
+    assert metadata["unit"] == "mm/h"
+    assert metadata["x1"] < metadata["x2"]
+    assert metadata["y1"] < metadata["y2"]
+
+
+def test_importer_cache():
+    """Test that cached imports return new arrays with the same values."""
+
+    from pysteps_importer_pincast.importer_pincast_netcdf import (
+        _open_cached,
+        importer_pincast_netcdf,
+    )
+
+    importer_pincast_netcdf.cache_clear()
+    importer_pincast_netcdf(TEST_FILE)
+    assert _open_cached.cache_info().currsize == 0
+
+    precip, _, metadata = importer_pincast_netcdf(
+        TEST_FILE, dtype="float32", cache=True
+    )
+    expected = precip.copy()
+    precip[:] = 0
+    precip_cached, _, metadata_cached = importer_pincast_netcdf(
+        TEST_FILE, dtype="float32", cache=True
+    )
+    assert _open_cached.cache_info().hits == 1
+    np.testing.assert_array_equal(precip_cached, expected)
+    assert metadata_cached == metadata
+    importer_pincast_netcdf.cache_clear()
+
+
+def test_read_pincast_metadata():
+    """Test that the metadata is read as by the importer registered in pysteps."""
+
+    from pysteps.io import get_method
+
+    from pysteps_importer_pincast.importer_pincast_netcdf import (
+        read_pincast_metadata,
+    )
+
+    importer = get_method("importer_pincast_netcdf", "importer")
+    _, _, metadata = importer(TEST_FILE)
+    assert read_pincast_metadata(TEST_FILE) == metadata
+
+    bbox = (-10000, -20000, 10000, 20000)
+    _, _, metadata_bbox = importer(TEST_FILE, bbox=bbox)
+    assert read_pincast_metadata(TEST_FILE, bbox=bbox) == metadata_bbox
+
+
+def test_importer_bbox():
+    """Test that only the pixels inside the bounding box are imported."""
+
+    from pysteps_importer_pincast.importer_pincast_netcdf import (
+        importer_pincast_netcdf,
+    )
+
+    precip, _, metadata = importer_pincast_netcdf(TEST_FILE, dtype="float32")
+
+    bbox = (-10000, -20000, 10000, 20000)
+    precip_bbox, _, metadata_bbox = importer_pincast_netcdf(
+        TEST_FILE, dtype="float32", bbox=bbox
+    )
+
+    assert metadata["x1"] <= metadata_bbox["x1"] and metadata_bbox["x2"] <= bbox[2]
+    assert metadata["y1"] <= metadata_bbox["y1"] and metadata_bbox["y2"] <= bbox[3]
+    assert metadata_bbox["x1"] >= bbox[0] and metadata_bbox["y1"] >= bbox[1]
+
+    xsize = abs(metadata["xpixelsize"])
+    ysize = abs(metadata["ypixelsize"])
+    nx = round((metadata_bbox["x2"] - metadata_bbox["x1"]) / xsize) + 1
+    ny = round((metadata_bbox["y2"] - metadata_bbox["y1"]) / ysize) + 1
+    assert precip_bbox.shape == (ny, nx)
+    assert precip_bbox.shape[0] < precip.shape[0]
+    assert precip_bbox.shape[1] < precip.shape[1]
+
+
+@pytest.mark.parametrize("kernel", ["numba", "numpy"])
+def test_importer_packed_field(tmp_path, monkeypatch, kernel):
+    """Test that packed fields with fill values are decoded as by xarray."""
+
+    from pysteps_importer_pincast import importer_pincast_netcdf as module
+
+    if kernel == "numba" and module._get_cast_kernel() is None:
+        pytest.skip("numba is not installed")
+    if kernel == "numpy":
+        monkeypatch.setattr(module, "_get_cast_kernel", lambda: None)
+    # Decode the fields with _decode_float32 instead of the fast reader
+    monkeypatch.setattr(module, "_get_fastread", lambda: None)
+
+    filename = _write_packed_file(str(tmp_path / "packed.nc"))
+    precip, _, metadata = module.importer_pincast_netcdf(filename, dtype="float32")
+
+    expected = _decoded_by_xarray(filename)
+    assert np.isnan(precip[:5, :5]).all()
+    np.testing.assert_allclose(precip, expected, rtol=1e-6, atol=1e-6)
+    assert metadata["institution"] == "TEST"
+    assert metadata["cartesian_unit"] == "m"
+
+
+@pytest.mark.parametrize("file_format", ["NETCDF3_CLASSIC", "NETCDF3_64BIT_OFFSET"])
+@pytest.mark.parametrize("bbox", [None, (5000, 10000, 30000, 25000)])
+def test_importer_classic_file(tmp_path, file_format, bbox):
+    """Test that classic netcdf files are imported as the HDF5 based files."""
+
+    from pysteps_importer_pincast.importer_pincast_netcdf import (
+        importer_pincast_netcdf,
+    )
+
+    # The data of classic files is big-endian, which is not native here
+    filename = _write_packed_file(str(tmp_path / "classic.nc"), file_format)
+    reference = _write_packed_file(str(tmp_path / "hdf5.nc"))
+    with open(filename, "rb") as f:
+        assert f.read(3) == b"CDF"
+
+    precip, _, metadata = importer_pincast_netcdf(
+        filename, dtype="float32", bbox=bbox
+    )
+    expected, _, expected_metadata = importer_pincast_netcdf(
+        reference, dtype="float32", bbox=bbox
+    )
+
+    np.testing.assert_array_equal(precip, expected)
+    assert metadata == expected_metadata
+
+
+def test_importer_classic_file_decoded_once(tmp_path, monkeypatch):
+    """Test that the fields of classic files are only decoded once, and are
+    copied from the cache."""
+
+    from pysteps_importer_pincast import importer_pincast_netcdf as module
+
+    calls = []
+    decode_float32 = module._decode_float32
+
+    def _counting_decode_float32(raw, attrs):
+        calls.append(raw.shape)
+        return decode_float32(raw, attrs)
+
+    monkeypatch.setattr(module, "_decode_float32", _counting_decode_float32)
+
+    filename = _write_packed_file(str(tmp_path / "classic.nc"), "NETCDF3_CLASSIC")
+    precip, _, _ = module.importer_pincast_netcdf(filename, dtype="float32")
+    assert len(calls) == 1
+
+    module.importer_pincast_netcdf.cache_clear()
+    precip, _, _ = module.importer_pincast_netcdf(
+        filename, dtype="float32", cache=True
+    )
+    expected = precip.copy()
+    precip[:] = 0
+    precip_cached, _, _ = module.importer_pincast_netcdf(
+        filename, dtype="float32", cache=True
+    )
+    np.testing.assert_array_equal(precip_cached, expected)
+    module.importer_pincast_netcdf.cache_clear()
+
+
+@pytest.mark.parametrize("bbox", [None, (5000, 10000, 30000, 25000)])
+def test_fastread_matches_netcdf4(tmp_path, monkeypatch, bbox):
+    """Test that the fast reader decodes the fields as the netCDF4 reader."""
+
+    fastread = pytest.importorskip("pysteps_importer_pincast._fastread")
+    import functools
+
+    import netCDF4
+
+    from pysteps_importer_pincast import importer_pincast_netcdf as module
+
+    filename = _write_packed_file(str(tmp_path / "packed.nc"))
+    # Valid int32 values next to the fill value are equal to it in float32
+    with netCDF4.Dataset(filename, "a") as nc:
+        count = nc.createVariable(
+            "COUNT", "i4", ("time", "y", "x"), fill_value=np.int32(-2147483647)
+        )
+        count.set_auto_maskandscale(False)
+        count[:] = np.full((1, 40, 50), -2147483646, dtype=np.int32)
+        count[0, :5, :5] = -2147483647
+
+    precip, quality, x, y, wkt, institution = fastread.read(
+        filename,
+        "RATE",
+        "COUNT",
+        subset=functools.partial(module._subset_slices, bbox=bbox),
+    )
+
+    monkeypatch.setattr(module, "_get_fastread", lambda: None)
+    expected = module._read_fields(filename, "RATE", "COUNT", bbox)
+
+    np.testing.assert_array_equal(
+        precip, module._decode_float32(expected.precip, expected.precip_attrs)
+    )
+    np.testing.assert_array_equal(
+        quality, module._decode_float32(expected.quality, expected.quality_attrs)
+    )
+    assert np.isnan(quality).sum() == (25 if bbox is None else 0)
+    np.testing.assert_array_equal(x, expected.x)
+    np.testing.assert_array_equal(y, expected.y)
+    assert wkt == expected.wkt
+    assert institution == expected.institution == "TEST"
+
+
+@pytest.mark.parametrize("field", ["spatial_ref", "x"])
+def test_fastread_rejects_non_2d_fields(tmp_path, field):
+    """Test that the fast reader raises a RuntimeError for 0D and 1D fields."""
+
+    fastread = pytest.importorskip("pysteps_importer_pincast._fastread")
+
+    filename = _write_packed_file(str(tmp_path / "packed.nc"))
+    with pytest.raises(RuntimeError, match="at least 2 dimensions"):
+        fastread.read(filename, "RATE", field)
+
+
+def test_importer_mf():
+    """Test that the multi-file importer stacks the fields of the files."""
+
+    from pysteps_importer_pincast.importer_pincast_netcdf import (
+        importer_pincast_netcdf,
+        importer_pincast_netcdf_mf,
+    )
+
+    precip, _, metadata = importer_pincast_netcdf(TEST_FILE, dtype="float32")
+    precip_mf, _, metadata_mf = importer_pincast_netcdf_mf(
+        [TEST_FILE, TEST_FILE], dtype="float32"
+    )
+
+    assert precip_mf.shape == (2,) + precip.shape
+    np.testing.assert_array_equal(precip_mf[0], precip)
+    np.testing.assert_array_equal(precip_mf[1], precip)
+    assert metadata_mf == metadata
+
+
+def test_importer_mf_without_time(tmp_path):
+    """Test that fields without a time dimension are stacked along a new one."""
+
+    from pysteps_importer_pincast.importer_pincast_netcdf import (
+        importer_pincast_netcdf,
+        importer_pincast_netcdf_mf,
+    )
+
+    filename = _write_packed_file(str(tmp_path / "packed.nc"), time=False)
+    precip, _, metadata = importer_pincast_netcdf(filename, dtype="float32")
+    precip_mf, _, metadata_mf = importer_pincast_netcdf_mf(
+        [filename, filename], dtype="float32"
+    )
+
+    assert precip_mf.shape == (2,) + precip.shape
+    np.testing.assert_array_equal(precip_mf[0], precip)
+    np.testing.assert_array_equal(precip_mf[1], precip)
+    assert metadata_mf == metadata
+
+
+def test_importer_mf_different_grids(tmp_path):
+    """Test that files with different grids are not combined."""
+
+    import netCDF4
+
+    from pysteps_importer_pincast.importer_pincast_netcdf import (
+        importer_pincast_netcdf_mf,
+    )
+
+    filename = _write_packed_file(str(tmp_path / "packed.nc"))
+    flipped = _write_packed_file(str(tmp_path / "flipped.nc"))
+    with netCDF4.Dataset(flipped, "a") as nc:
+        nc.variables["y"][:] = nc.variables["y"][::-1]
+
+    with pytest.raises(ValueError):
+        importer_pincast_netcdf_mf([filename, flipped])